@@ -1,26 +1,51 @@
 import os
-from typing import List, Optional, Union, Dict
+import asyncio
+import functools
+from typing import Any, List, Optional, Union, Dict, Tuple
+from collections import OrderedDict
 from dotenv import load_dotenv, find_dotenv
 from mcp.server.fastmcp import FastMCP
-from supabase import create_client, Client
-from openai import OpenAI
-from pydantic import BaseModel
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, BadRequestError, InternalServerError, RateLimitError
+from pydantic import BaseModel, ConfigDict, field_serializer, field_validator
+import numpy as np
+import tiktoken
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import atexit
 from pathlib import Path
 import httpx
 import uuid
 import hashlib
-from datetime import datetime
+import base64
+import warnings
+import sqlite3
+import threading
+import time
+import random
+import re
+from datetime import datetime, timezone
 
-# Configure logging with both file and console handlers
+# Configure logging with both file and console handlers. Records are only
+# enqueued on the calling thread; a background listener thread does the file
+# and console writes so they never block the event loop. The log file is
+# rotated at 50 MB, keeping the last 5 files.
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(
+    log_queue,
+    RotatingFileHandler('rag_server.log', maxBytes=50_000_000, backupCount=5),
+    logging.StreamHandler(),
+    respect_handler_level=True
+)
+# The format is applied once by the QueueHandler before enqueueing
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('rag_server.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 def load_env_file() -> None:
@@ -77,177 +102,856 @@ try:
     OPENAI_MODEL = get_env_var("OPENAI_MODEL", "text-embedding-3-small")
     DOCUMENTS_TABLE = get_env_var("DOCUMENTS_TABLE")
     DEFAULT_SEARCH_LIMIT = int(get_env_var("DEFAULT_SEARCH_LIMIT", "7"))
+    SEARCH_SNIPPET_LENGTH = int(get_env_var("SEARCH_SNIPPET_LENGTH", "512"))
     PORT = int(get_env_var("PORT", "8000"))
+    # OpenAI accepts at most 2048 inputs per embeddings request
+    EMBEDDING_BATCH_SIZE = min(int(get_env_var("EMBEDDING_BATCH_SIZE", "96")), 2048)
+    EMBEDDING_BATCH_TOKENS = int(get_env_var("EMBEDDING_BATCH_TOKENS", "8000"))
+    EMBEDDING_BATCH_WINDOW_MS = float(get_env_var("EMBEDDING_BATCH_WINDOW_MS", "10"))
+    EMBEDDING_CONCURRENCY = int(get_env_var("EMBEDDING_CONCURRENCY", "5"))
+    EMBEDDING_MAX_RETRIES = int(get_env_var("EMBEDDING_MAX_RETRIES", "5"))
+    EMBEDDING_CACHE_CAPACITY = int(get_env_var("EMBEDDING_CACHE_CAPACITY", "10000"))
+    EMBEDDING_CACHE_PATH = get_env_var("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+    EMBEDDING_CACHE_TTL = float(get_env_var("EMBEDDING_CACHE_TTL", "0"))
+    EMBEDDING_CACHE_MAX_ROWS = int(get_env_var("EMBEDDING_CACHE_MAX_ROWS", "50000"))
+    SEARCH_CACHE_CAPACITY = int(get_env_var("SEARCH_CACHE_CAPACITY", "1024"))
+    SEARCH_CACHE_TTL = float(get_env_var("SEARCH_CACHE_TTL", "60"))
+    LOG_LEVEL = get_env_var("LOG_LEVEL", "INFO").upper()
+    SUPABASE_MAX_CONNECTIONS = int(get_env_var("SUPABASE_MAX_CONNECTIONS", "120"))
+    SUPABASE_MAX_KEEPALIVE = int(get_env_var("SUPABASE_MAX_KEEPALIVE", "80"))
+    OPENAI_MAX_CONNECTIONS = int(get_env_var("OPENAI_MAX_CONNECTIONS", "128"))
+    OPENAI_MAX_KEEPALIVE = int(get_env_var("OPENAI_MAX_KEEPALIVE", "64"))
 except ValueError as e:
     logger.error("Failed to load required environment variables")
     raise
 
+# Length of the embeddings recorded in note metadata; fixed by the
+# halfvec(1536) column in setup.sql
+EMBEDDING_DIMENSION = 1536
+
+# Apply the configured log level; per-document search logging only runs at DEBUG
+logging.getLogger().setLevel(LOG_LEVEL)
+
 # Log startup configuration (with sensitive data masked)
 logger.info("Starting RAG Server with configuration:")
 logger.info(f"Supabase URL: {SUPABASE_URL}")
 logger.info(f"Supabase Key: {'*' * len(SUPABASE_ANON_KEY)}")
-logger.info(f"OpenAI Model: {OPENAI_MODEL}")
+logger.info(f"OpenAI Model: {OPENAI_MODEL} ({EMBEDDING_DIMENSION} dimensions)")
+logger.info(f"OpenAI Connection Pool: {OPENAI_MAX_CONNECTIONS} max / {OPENAI_MAX_KEEPALIVE} keep-alive")
 logger.info(f"Documents Table: {DOCUMENTS_TABLE}")
+logger.info(f"Supabase Connection Pool: {SUPABASE_MAX_CONNECTIONS} max / {SUPABASE_MAX_KEEPALIVE} keep-alive")
 logger.info(f"Default Search Limit: {DEFAULT_SEARCH_LIMIT}")
+logger.info(f"Search Snippet Length: {SEARCH_SNIPPET_LENGTH}")
 logger.info(f"Server Port: {PORT}")
+logger.info(f"Embedding Batch Size: {EMBEDDING_BATCH_SIZE} inputs / {EMBEDDING_BATCH_TOKENS} tokens")
+logger.info(f"Embedding Batch Window: {EMBEDDING_BATCH_WINDOW_MS} ms")
+logger.info(f"Embedding Concurrency: {EMBEDDING_CONCURRENCY} (max retries: {EMBEDDING_MAX_RETRIES})")
+logger.info(f"Embedding Cache Capacity: {EMBEDDING_CACHE_CAPACITY}")
+logger.info(f"Embedding Cache Path: {EMBEDDING_CACHE_PATH or 'disabled'} (TTL: {EMBEDDING_CACHE_TTL or 'none'}, max rows: {EMBEDDING_CACHE_MAX_ROWS or 'unlimited'})")
+logger.info(f"Search Cache: {SEARCH_CACHE_CAPACITY} entries (TTL: {SEARCH_CACHE_TTL or 'disabled'})")
 
-# Initialize Supabase client
-logger.info("Initializing Supabase client...")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Clients are process-wide singletons. Always go through get_supabase() /
+# get_openai(); never construct clients per request, as each new client pays
+# its own connection and TLS setup.
+supabase_client: Optional[AsyncClient] = None
+# Created on first use, inside the running event loop (see embedding_semaphore)
+supabase_client_lock: Optional[asyncio.Lock] = None
 
-# Initialize OpenAI client
-logger.info("Initializing OpenAI client...")
-http_client = httpx.Client(
-    base_url="https://api.openai.com/v1",
-    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
-)
+async def get_supabase() -> AsyncClient:
+    """Return the shared Supabase client, creating it on first use."""
+    global supabase_client, supabase_client_lock
+    if supabase_client is None:
+        if supabase_client_lock is None:
+            supabase_client_lock = asyncio.Lock()
+        async with supabase_client_lock:
+            if supabase_client is None:
+                logger.info("Initializing Supabase client...")
+                # Share one pooled HTTP/2 connection set across all PostgREST
+                # requests so they reuse warm sockets instead of paying a new
+                # TLS handshake
+                http_client = httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=SUPABASE_MAX_CONNECTIONS,
+                        max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+                        keepalive_expiry=30.0
+                    ),
+                    timeout=httpx.Timeout(10.0, connect=2.0)
+                )
+                supabase_client = await acreate_client(
+                    SUPABASE_URL,
+                    SUPABASE_ANON_KEY,
+                    options=AsyncClientOptions(
+                        httpx_client=http_client,
+                        auto_refresh_token=False,
+                        persist_session=False
+                    )
+                )
+    return supabase_client
 
-openai_client = OpenAI(
-    api_key=OPENAI_API_KEY,
-    http_client=http_client
-)
+@functools.lru_cache(maxsize=1)
+def get_openai() -> AsyncOpenAI:
+    """Return the shared OpenAI client, creating it on first use."""
+    logger.info("Initializing OpenAI client...")
+    # Concurrent embedding requests multiplex over pooled HTTP/2 connections
+    http_client = httpx.AsyncClient(
+        base_url="https://api.openai.com/v1",
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        http2=True,
+        # Idle connections are kept for 5 minutes so bursts after a lull skip the TLS handshake
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=300.0
+        ),
+        timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0)
+    )
+    # Retries are handled by embed_batch, so the SDK's own are disabled
+    # rather than compounding with ours
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=http_client,
+        max_retries=0
+    )
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_store() -> Optional[sqlite3.Connection]:
+    """Return the on-disk embedding cache, or None if EMBEDDING_CACHE_PATH is empty."""
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    logger.info(f"Opening embedding cache at {EMBEDDING_CACHE_PATH}...")
+    store = sqlite3.connect(EMBEDDING_CACHE_PATH, check_same_thread=False)
+    store.execute("PRAGMA journal_mode=WAL")
+    store.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings ("
+        "key BLOB PRIMARY KEY, vec BLOB NOT NULL, created_at REAL NOT NULL)"
+    )
+    # Pruning removes expired and oldest rows first
+    store.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+    store.commit()
+    return store
+
+# The store is used from worker threads; a sqlite3 connection must only be
+# used by one thread at a time
+embedding_store_lock = threading.Lock()
+
+def read_stored_embeddings(keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+    """
+    Look up embeddings in the on-disk cache. Blocking; run it in a thread.
+    
+    Args:
+        keys: Cache keys, see embedding_cache_key
+        
+    Returns:
+        The stored, unexpired embeddings found, by key
+    """
+    store = get_embedding_store()
+    if store is None:
+        return {}
+    oldest = time.time() - EMBEDDING_CACHE_TTL if EMBEDDING_CACHE_TTL > 0 else 0
+    found = {}
+    with embedding_store_lock:
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = store.execute(
+                f"SELECT key, vec FROM embeddings WHERE created_at >= ? AND key IN ({','.join('?' * len(chunk))})",
+                [oldest, *chunk]
+            ).fetchall()
+            found.update((key, to_vector(vec)) for key, vec in rows)
+    return found
+
+def write_stored_embeddings(embeddings: Dict[bytes, np.ndarray]) -> None:
+    """
+    Save embeddings, by key, to the on-disk cache. Blocking; run it in a thread.
+    
+    Expired rows are deleted, and the oldest rows are dropped once the cache
+    holds more than EMBEDDING_CACHE_MAX_ROWS.
+    """
+    store = get_embedding_store()
+    if store is None:
+        return
+    now = time.time()
+    with embedding_store_lock:
+        store.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vec, created_at) VALUES (?, ?, ?)",
+            [(key, embedding.tobytes(), now) for key, embedding in embeddings.items()]
+        )
+        if EMBEDDING_CACHE_TTL > 0:
+            store.execute("DELETE FROM embeddings WHERE created_at < ?", (now - EMBEDDING_CACHE_TTL,))
+        if EMBEDDING_CACHE_MAX_ROWS > 0:
+            store.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (EMBEDDING_CACHE_MAX_ROWS,)
+            )
+        store.commit()
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer() -> tiktoken.Encoding:
+    """Return the tokenizer used to size embedding inputs before sending them."""
+    # tiktoken downloads the encoding on first use, so don't do it at import
+    logger.info("Loading tokenizer...")
+    try:
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+# Longest input, in tokens, accepted by the OpenAI embedding models
+MAX_EMBEDDING_INPUT_TOKENS = 8191
+
+# Bounds the number of embedding requests in flight at once. Created on
+# first use: before Python 3.10, asyncio primitives bind to the event loop
+# current at creation, which is not the one the server runs on.
+embedding_semaphore: Optional[asyncio.Semaphore] = None
+
+# Recently computed embeddings, least recently used first
+embedding_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+
+# Embeddings currently being requested, shared by concurrent callers
+embedding_inflight: "Dict[bytes, asyncio.Future[np.ndarray]]" = {}
+
+class EmbeddingRequestCancelled(Exception):
+    """Set on shared embedding futures whose owning request was cancelled."""
+
+# Texts waiting to be embedded, as (text, token count, future), and the
+# background task that batches them; started on first use
+embedding_queue: Optional[asyncio.Queue] = None
+embedding_batcher: Optional[asyncio.Task] = None
+# Batch requests in flight, referenced so they aren't garbage collected
+embedding_batch_tasks: set = set()
+
+# Recent search results by (query, limit, snippet_length), as (time stored,
+# results), least recently used first
+search_cache: "OrderedDict[Tuple[str, int, int], Tuple[float, List[SearchResult]]]" = OrderedDict()
+# Bumped on every write, so searches started before a write don't cache
+# results that may already be stale
+search_cache_generation = 0
 
 # Create MCP server
 logger.info("Creating MCP server...")
 mcp = FastMCP("RAG Server")
 
+def parse_vector(text: str) -> Optional[np.ndarray]:
+    """
+    Parse pgvector's "[x,y,...]" text representation into a float32 array
+    in a single C call. Returns None if the text is not a valid vector.
+    """
+    # np.fromstring only warns and returns a partial array on malformed input
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(text.strip('[]'), sep=',', dtype=np.float32)
+        except (ValueError, DeprecationWarning):
+            return None
+
+def to_vector(value: Any) -> Optional[np.ndarray]:
+    """
+    Coerce an embedding (pgvector text, raw float32 bytes or a sequence of
+    numbers) to a float32 array.
+    """
+    # Keep embeddings packed as float32 instead of lists of Python floats
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return parse_vector(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
 class Document(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
     id: int
     content: str
-    embedding: Optional[List[float]] = None
+    embedding: Optional[Any] = None
     metadata: Optional[dict] = None
 
+    @field_validator('embedding', mode='before')
+    @classmethod
+    def embedding_to_array(cls, value: Any) -> Optional[np.ndarray]:
+        # Accepts pgvector text, raw float32 bytes or a sequence of numbers
+        return to_vector(value)
+
+    @field_serializer('embedding')
+    def serialize_embedding(self, value: Optional[np.ndarray]) -> Optional[List[float]]:
+        return None if value is None else value.tolist()
+
+    # Rows from our own database are trusted, so they are built with
+    # model_construct and skip field validation; use model_validate for
+    # anything coming from outside.
     @classmethod
     def from_supabase(cls, data: dict) -> 'Document':
-        # Convert string embedding to list of floats if it exists
-        if 'embedding' in data and isinstance(data['embedding'], str):
-            try:
-                # Remove brackets and split by comma
-                embedding_str = data['embedding'].strip('[]')
-                data['embedding'] = [float(x) for x in embedding_str.split(',')]
-            except (ValueError, AttributeError):
-                data['embedding'] = None
-        return cls(**data)
+        # model_construct skips embedding_to_array, so pack the vector here
+        data['embedding'] = to_vector(data.get('embedding'))
+        return cls.model_construct(**data)
+
+def make_snippet(content: str, query: str, length: int) -> str:
+    """
+    Cut a window of at most length characters out of content, centred on the
+    first occurrence of a query word if there is one, else from the start.
+    A length of 0 or less returns the whole content.
+    """
+    if length <= 0 or len(content) <= length:
+        return content
+    # Ignore very short words such as "a" or "of", which match almost anywhere
+    words = [re.escape(word) for word in query.split() if len(word) > 2]
+    match = re.search('|'.join(words), content, re.IGNORECASE) if words else None
+    start = 0
+    if match:
+        start = max(0, min(match.start() - length // 2, len(content) - length))
+    return content[start:start + length]
+
+class SearchResult(BaseModel):
+    # No embedding field: search hits never carry the vector. Long notes are
+    # cut down to a snippet; get_note returns the full content.
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+    id: int
+    snippet: str
+    truncated: bool
+    metadata: Optional[dict] = None
+    similarity: float
+
+    @classmethod
+    def from_search_row(cls, data: dict, query: str, snippet_length: int) -> 'SearchResult':
+        # Trusted match_documents row, see Document.from_supabase
+        snippet = make_snippet(data['content'], query, snippet_length)
+        return cls.model_construct(
+            id=data['id'],
+            snippet=snippet,
+            truncated=len(snippet) < len(data['content']),
+            metadata=data.get('metadata'),
+            similarity=data['similarity']
+        )
 
 class DocumentMetadata(BaseModel):
+    # Notes carry many more metadata fields than the ones checked here
+    model_config = ConfigDict(extra='allow')
+
     loc: Optional[dict] = None
     source: Optional[str] = None
     file_id: Optional[str] = None
     blobType: Optional[str] = None
 
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens in a text with the embedding model's tokenizer.
+    
+    Raises:
+        ValueError: If the text is empty or longer than the model accepts
+    """
+    # OpenAI rejects empty inputs, and would fail the whole shared batch
+    if not text.strip():
+        error_msg = "Cannot embed an empty text"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    # Notes may legitimately contain special-token text such as <|endoftext|>
+    tokens = len(get_tokenizer().encode(text, disallowed_special=()))
+    if tokens > MAX_EMBEDDING_INPUT_TOKENS:
+        error_msg = f"Text is {tokens} tokens long, the embedding model accepts at most {MAX_EMBEDDING_INPUT_TOKENS}"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    return tokens
+
+def batch_for_embedding(items: List[Tuple[Any, int]]) -> List[List[Any]]:
+    """
+    Split items into batches that fit a single embeddings request.
+    
+    Args:
+        items: (item, token count) pairs, in order
+        
+    Returns:
+        Consecutive batches of at most EMBEDDING_BATCH_SIZE items and
+        EMBEDDING_BATCH_TOKENS tokens each (a single longer item gets its own batch)
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for item, tokens in items:
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """Seconds the server asked us to wait before retrying, if it said."""
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        # Retry-After may also be an HTTP date; fall back to our own backoff
+        pass
+    return None
+
+async def embed_batch(batch: List[str]) -> List[np.ndarray]:
+    """
+    Embed a batch of texts with a single OpenAI request, backing off and
+    retrying on rate limits and transient failures.
+    
+    Args:
+        batch: The texts to embed
+        
+    Returns:
+        One float32 embedding per text, in input order
+    """
+    global embedding_semaphore
+    if embedding_semaphore is None:
+        embedding_semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            async with embedding_semaphore:
+                # base64 float32 is about 4x smaller on the wire than JSON floats
+                response = await get_openai().embeddings.create(
+                    model=OPENAI_MODEL,
+                    input=batch,
+                    encoding_format="base64"
+                )
+            break
+        except (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError) as e:
+            if attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            # Honour the server's Retry-After on rate limits, else back off
+            # exponentially; jitter keeps concurrent batches from retrying in lockstep
+            delay = min(2 ** attempt, 30)
+            if isinstance(e, RateLimitError):
+                delay = get_retry_after(e.response) or delay
+            delay += random.uniform(0, 0.25)
+            logger.warning(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+    return [np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32) for item in response.data]
+
+async def send_embedding_batch(batch: List[Tuple[str, "asyncio.Future[np.ndarray]"]]) -> None:
+    """Embed a batch of queued texts and resolve their futures."""
+    try:
+        embeddings = await embed_batch([text for text, _ in batch])
+    except Exception as e:
+        if isinstance(e, BadRequestError) and len(batch) > 1:
+            # The batch mixes texts from unrelated callers; re-send them one
+            # by one so only the caller with the invalid input fails
+            logger.warning(f"Embedding batch rejected ({str(e)}), retrying its {len(batch)} texts individually")
+            await asyncio.gather(*(send_embedding_batch([item]) for item in batch))
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), embedding in zip(batch, embeddings):
+        # Skip callers that were cancelled while waiting
+        if not future.done():
+            future.set_result(embedding)
+
+async def run_embedding_batcher(pending: asyncio.Queue) -> None:
+    """
+    Coalesce queued texts into batched embedding requests.
+    
+    Waits up to EMBEDDING_BATCH_WINDOW_MS after the first queued text for
+    more to arrive (or until a full batch is queued), then sends what it
+    collected as one or more batches without waiting for the responses.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        collected = [await pending.get()]
+        deadline = loop.time() + EMBEDDING_BATCH_WINDOW_MS / 1000
+        while len(collected) < EMBEDDING_BATCH_SIZE:
+            if pending.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    collected.append(await asyncio.wait_for(pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                collected.append(pending.get_nowait())
+        
+        for batch in batch_for_embedding([((text, future), tokens) for text, tokens, future in collected]):
+            task = asyncio.create_task(send_embedding_batch(batch))
+            embedding_batch_tasks.add(task)
+            task.add_done_callback(embedding_batch_tasks.discard)
+
+async def request_embeddings(texts: List[str]) -> List[np.ndarray]:
+    """
+    Embed texts through the shared micro-batching queue, so concurrent
+    callers share OpenAI requests.
+    
+    Args:
+        texts: The texts to embed
+        
+    Returns:
+        One embedding per text, in input order
+        
+    Raises:
+        ValueError: If a text is empty or longer than the model accepts
+    """
+    global embedding_queue, embedding_batcher
+    token_counts = [count_tokens(text) for text in texts]
+    
+    if embedding_batcher is None or embedding_batcher.done():
+        embedding_queue = asyncio.Queue()
+        embedding_batcher = asyncio.create_task(run_embedding_batcher(embedding_queue))
+    
+    loop = asyncio.get_running_loop()
+    futures = []
+    for text, tokens in zip(texts, token_counts):
+        future = loop.create_future()
+        embedding_queue.put_nowait((text, tokens, future))
+        futures.append(future)
+    
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+def embedding_cache_key(text: str) -> bytes:
+    """Key identifying the embedding of a text under the configured model."""
+    return hashlib.sha256((OPENAI_MODEL + '\0' + text).encode()).digest()
+
+async def embed_texts(texts: List[str]) -> List[np.ndarray]:
+    """
+    Embed texts, serving repeated texts from the in-process cache, then
+    from the on-disk cache.
+    
+    Texts already being embedded by another caller wait for that request
+    instead of sending their own, and embed the text themselves if that
+    caller is cancelled. The remaining misses are deduplicated and sent
+    through the micro-batching queue.
+    
+    Args:
+        texts: The texts to embed
+        
+    Returns:
+        One embedding per text, in input order
+    """
+    keys = [embedding_cache_key(text) for text in texts]
+    
+    # The cache is only touched between awaits, so no lock is needed
+    found = {}
+    pending = {}
+    missing = {}
+    for key, text in zip(keys, texts):
+        embedding = embedding_cache.get(key)
+        if embedding is not None:
+            embedding_cache.move_to_end(key)
+            found[key] = embedding
+        elif key in embedding_inflight:
+            pending[key] = (embedding_inflight[key], text)
+        else:
+            missing.setdefault(key, text)
+    
+    if missing:
+        logger.debug(f"Embedding cache: {len(found)} hits, {len(pending)} in flight, {len(missing)} misses")
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in missing}
+        embedding_inflight.update(futures)
+        try:
+            try:
+                fetched = await asyncio.to_thread(read_stored_embeddings, list(missing))
+            except sqlite3.Error as e:
+                logger.warning(f"Embedding cache lookup failed: {str(e)}")
+                fetched = {}
+            
+            unstored = {key: text for key, text in missing.items() if key not in fetched}
+            if unstored:
+                embedded = dict(zip(unstored, await request_embeddings(list(unstored.values()))))
+                try:
+                    await asyncio.to_thread(write_stored_embeddings, embedded)
+                except sqlite3.Error as e:
+                    logger.warning(f"Embedding cache write failed: {str(e)}")
+                fetched.update(embedded)
+        except BaseException as e:
+            # Fail everyone waiting on these texts; the next call retries them
+            for key, future in futures.items():
+                del embedding_inflight[key]
+                # Waiters retry on their own when this caller was cancelled,
+                # rather than being cancelled with it
+                future.set_exception(e if isinstance(e, Exception) else EmbeddingRequestCancelled())
+                future.exception()  # Don't warn when nobody was waiting
+            raise
+        
+        for key in missing:
+            embedding = fetched[key]
+            found[key] = embedding
+            embedding_cache[key] = embedding
+            del embedding_inflight[key]
+            futures[key].set_result(embedding)
+        while len(embedding_cache) > EMBEDDING_CACHE_CAPACITY:
+            embedding_cache.popitem(last=False)
+    
+    for key, (future, text) in pending.items():
+        try:
+            # Shielded so that cancelling this caller doesn't cancel the
+            # shared future for everyone else waiting on it
+            found[key] = await asyncio.shield(future)
+        except EmbeddingRequestCancelled:
+            found[key] = (await embed_texts([text]))[0]
+    
+    return [found[key] for key in keys]
+
+async def embed(text: str) -> np.ndarray:
+    """Embed a single text, see embed_texts."""
+    return (await embed_texts([text]))[0]
+
+# match_documents filter used by every search. Shared across requests, so it
+# must never be mutated.
+EMPTY_FILTER: Dict = {}
+
+def invalidate_search_cache() -> None:
+    """Drop cached search results after notes were added or deleted."""
+    global search_cache_generation
+    search_cache_generation += 1
+    search_cache.clear()
+
 @mcp.tool("search_note")
-async def search_documents(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[Document]:
+async def search_documents(
+    query: str,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+    snippet_length: int = SEARCH_SNIPPET_LENGTH
+) -> List[SearchResult]:
     """
     Search for user knowledge database (notes) using semantic similarity with the given query.
     
     Args:
         query (str): The search query text
         limit (int): Maximum number of notes to return (defaults to DEFAULT_SEARCH_LIMIT from environment)
+        snippet_length (int): Maximum characters of each note to return, around the first query
+            word found (defaults to SEARCH_SNIPPET_LENGTH from environment; 0 returns full notes).
+            Use get_note to fetch the full content of a truncated note.
         
     Returns:
         List of relevant notes
     """
     logger.info(f"Starting document search with query: '{query}' (limit: {limit})")
     
+    # Repeated searches within SEARCH_CACHE_TTL are served from memory
+    cache_key = (query, limit, snippet_length)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        if time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+            search_cache.move_to_end(cache_key)
+            logger.info(f"Returning {len(cached[1])} cached results")
+            return list(cached[1])
+        del search_cache[cache_key]
+    generation = search_cache_generation
+    
     try:
         # Generate embedding for the query
         logger.debug("Generating query embedding...")
-        query_embedding = openai_client.embeddings.create(
-            model=OPENAI_MODEL,
-            input=query
-        ).data[0].embedding
+        query_embedding = await embed(query)
         
         logger.info(f"Generated query embedding of length: {len(query_embedding)}")
         
         # Query Supabase for similar documents
         logger.debug("Querying Supabase for similar documents...")
-        response = supabase.rpc(
+        supabase = await get_supabase()
+        response = await supabase.rpc(
             'match_documents',
             {
-                'query_embedding': query_embedding,
+                'query_embedding': query_embedding.tolist(),
                 'match_count': limit,
-                'filter': {}
+                'filter': EMPTY_FILTER
             }
         ).execute()
         
-        # Process and sort results by similarity
-        results = []
-        for doc in response.data:
-            # Convert the distance-based similarity to a proper similarity score
-            distance = 1 - doc.get('similarity', 0)
-            similarity = 1 - (distance / 2)
-            
-            # Create a new document with the corrected similarity
-            doc_copy = doc.copy()
-            doc_copy['similarity'] = similarity
-            results.append(doc_copy)
-        
-        # Sort by similarity in descending order
-        results.sort(key=lambda x: x['similarity'], reverse=True)
+        # match_documents returns the final [0, 1] similarity, best match first
+        results = response.data
         
         # Log the results
         logger.info(f"Found {len(results)} matching documents")
-        for doc in results:
-            logger.debug(f"Document ID={doc['id']}, Similarity={doc['similarity']:.3f}")
-            logger.debug(f"Content preview: {doc['content'][:100]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            for doc in results:
+                logger.debug("Document ID=%s, Similarity=%.3f", doc['id'], doc['similarity'])
+                logger.debug("Content preview: %.100s...", doc['content'])
         
-        return [Document.from_supabase(doc) for doc in results]
+        search_results = [SearchResult.from_search_row(doc, query, snippet_length) for doc in results]
+        if SEARCH_CACHE_TTL > 0 and generation == search_cache_generation:
+            search_cache[cache_key] = (time.monotonic(), search_results)
+            while len(search_cache) > SEARCH_CACHE_CAPACITY:
+                search_cache.popitem(last=False)
+        return list(search_results)
     except Exception as e:
         logger.error(f"Error during document search: {str(e)}")
         raise
 
-@mcp.tool("add_note")
-async def add_note(content: str, metadata: Optional[Dict] = None) -> Dict:
-    """Add a new note to the user knowledge database."""
+def build_note_metadata(content: str, metadata: Optional[Dict], now_iso: str) -> Dict:
+    """
+    Build the metadata stored with a note, merging any provided metadata
+    over the defaults used for notes coming from chat.
+    
+    Args:
+        content: The note content
+        metadata: Metadata provided for the note, if any
+        now_iso: Current UTC time in ISO format, used for all timestamps
+    """
+    # Encode once: the byte length is the file size, the bytes are hashed
+    raw = content.encode("utf-8")
+    default_metadata = {
+        "loc": None,
+        "source": "from_chat",
+        "file_id": str(uuid.uuid4()),  # Generate unique ID for chat messages
+        "blobType": "text",
+        "filename": None,
+        "path": None,
+        "directory": None,
+        "file_extension": None,
+        "file_size": len(raw),
+        "file_hash": hashlib.sha256(raw).hexdigest(),
+        "content_length": len(content),
+        "is_truncated": False,
+        "last_modified": now_iso,
+        "created_at": now_iso,
+        "processing_info": {
+            "model": OPENAI_MODEL,
+            "processed_at": now_iso,
+            "embedding_dimension": EMBEDDING_DIMENSION
+        }
+    }
+
+    # Merge with provided metadata if any, validated once; None values are
+    # dropped so they cannot blank out required defaults such as source
+    if metadata:
+        default_metadata.update(DocumentMetadata.model_validate(metadata).model_dump(exclude_none=True))
+    return default_metadata
+
+@mcp.tool("add_notes")
+async def add_notes(items: List[Tuple[str, Optional[Dict]]]) -> List[Dict]:
+    """
+    Add several notes to the user knowledge database at once.
+    
+    Notes whose file_hash is already stored are not embedded or inserted
+    again; the stored note is returned instead.
+    
+    Args:
+        items (List[Tuple[str, Optional[Dict]]]): (content, metadata) pairs; metadata may be null
+        
+    Returns:
+        The added (or already stored) notes, in the same order as the input
+    """
+    logger.info(f"Adding {len(items)} notes")
+    if not items:
+        return []
+    
     try:
-        # Generate embedding for the content
-        response = await openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=content
-        )
-        embedding = response.data[0].embedding
-
-        # Prepare metadata with default values and chat source
-        default_metadata = {
-            "loc": None,
-            "source": "from_chat",
-            "file_id": str(uuid.uuid4()),  # Generate unique ID for chat messages
-            "blobType": "text",
-            "filename": None,
-            "path": None,
-            "directory": None,
-            "file_extension": None,
-            "file_size": len(content),
-            "file_hash": hashlib.sha256(content.encode()).hexdigest(),
-            "content_length": len(content),
-            "is_truncated": False,
-            "last_modified": datetime.now().isoformat(),
-            "created_at": datetime.now().isoformat(),
-            "processing_info": {
-                "model": "text-embedding-3-small",
-                "processed_at": datetime.now().isoformat(),
-                "embedding_dimension": 1536
-            }
+        now_iso = datetime.now(timezone.utc).isoformat()
+        notes = [
+            {"content": content, "metadata": build_note_metadata(content, metadata, now_iso)}
+            for content, metadata in items
+        ]
+        hashes = [note["metadata"]["file_hash"] for note in notes]
+        
+        # Look up notes that are already stored. The hashes go in the query
+        # string, ~67 bytes each, so look them up 100 at a time to keep URLs
+        # well within gateway limits.
+        supabase = await get_supabase()
+        unique_hashes = list(set(hashes))
+        responses = await asyncio.gather(*(
+            supabase.table(DOCUMENTS_TABLE)
+                .select('id,content,metadata')
+                .in_('metadata->>file_hash', unique_hashes[start:start + 100])
+                .execute()
+            for start in range(0, len(unique_hashes), 100)
+        ))
+        notes_by_hash = {
+            row["metadata"]["file_hash"]: row
+            for response in responses
+            for row in response.data
         }
+        
+        # Only the first of several identical new notes is inserted
+        rows = []
+        for file_hash, note in zip(hashes, notes):
+            if file_hash not in notes_by_hash:
+                notes_by_hash[file_hash] = note
+                rows.append(note)
+        
+        if len(rows) < len(notes):
+            logger.info(f"Skipping {len(notes) - len(rows)} notes that are already stored")
+        
+        if rows:
+            embeddings = await embed_texts([row["content"] for row in rows])
+            for row, embedding in zip(rows, embeddings):
+                row["embedding"] = embedding.tolist()
+            
+            # Insert all new notes with a single request. Only the new ids are
+            # sent back: we already have the rest, and echoing each row would
+            # ship its embedding back over the wire.
+            result = await supabase.table(DOCUMENTS_TABLE).insert(rows).select('id').execute()
+            invalidate_search_cache()
+            
+            if not result.data:
+                raise Exception("Failed to add notes: No data returned from insert")
+            
+            logger.info(f"Successfully added {len(result.data)} notes")
+            for inserted, row in zip(result.data, rows):
+                row["id"] = inserted["id"]
+        
+        return [
+            {key: notes_by_hash[file_hash][key] for key in ("id", "content", "metadata")}
+            for file_hash in hashes
+        ]
+    except Exception as e:
+        logger.error(f"Error adding notes: {str(e)}")
+        raise
 
-        # Merge with provided metadata if any
-        if metadata:
-            default_metadata.update(metadata)
+@mcp.tool("add_note")
+async def add_note(content: str, metadata: Optional[Dict] = None) -> Dict:
+    """Add a new note to the user knowledge database."""
+    return (await add_notes([(content, metadata)]))[0]
 
-        # Insert into Supabase
-        result = supabase.table("notes").insert({
-            "content": content,
-            "embedding": embedding,
-            "metadata": default_metadata
-        }).execute()
+def normalize_note_id(note_id: Union[str, int]) -> Union[str, int]:
+    """
+    Return note_id as an int when it is numeric, so queries compare it
+    against the integer primary key directly. Other values are passed through
+    unchanged and left for the database to reject.
+    """
+    if isinstance(note_id, int):
+        return note_id
+    try:
+        return int(note_id)
+    except ValueError:
+        return note_id
 
-        if result.data:
-            return {"id": result.data[0]["id"], "content": content, "metadata": default_metadata}
+@mcp.tool("get_note")
+async def get_note(note_id: Union[str, int], include_embedding: bool = False) -> Optional[Document]:
+    """
+    Get a single note from user knowledge database.
+    
+    Args:
+        note_id (Union[str, int]): The ID of the note to get
+        include_embedding (bool): Whether to also return the note's embedding vector
+        
+    Returns:
+        The note, or None if no note has that ID
+    """
+    logger.info(f"Getting note with ID: {note_id}")
+    note_id = normalize_note_id(note_id)
+    
+    try:
+        # Only fetch the (large) embedding when it was asked for. get_document
+        # returns it as real[], i.e. a JSON number array, so no pgvector text
+        # has to be parsed on this side.
+        supabase = await get_supabase()
+        if include_embedding:
+            response = await supabase.rpc('get_document', {'note_id': note_id}).execute()
         else:
-            raise Exception("Failed to add note: No data returned from insert")
-
+            response = await supabase.table(DOCUMENTS_TABLE).select('id,content,metadata').eq('id', note_id).limit(1).execute()
+        
+        if not response.data:
+            logger.warning(f"No note found with ID: {note_id}")
+            return None
+        
+        return Document.from_supabase(response.data[0])
     except Exception as e:
-        logging.error(f"Error adding note: {str(e)}")
+        logger.error(f"Error getting note {note_id}: {str(e)}")
         raise
 
 @mcp.tool("delete_note")
@@ -262,14 +966,21 @@ async def delete_note(note_id: Union[str, int]) -> bool:
         True if the note was successfully deleted
     """
     logger.info(f"Attempting to delete note with ID: {note_id}")
+    note_id = normalize_note_id(note_id)
     
     try:
-        # Convert note_id to string if it's an integer
-        note_id_str = str(note_id)
-        response = supabase.table(DOCUMENTS_TABLE).delete().eq('id', note_id_str).execute()
+        # Only ask for the number of deleted rows, not the rows themselves
+        supabase = await get_supabase()
+        response = await (
+            supabase.table(DOCUMENTS_TABLE)
+                .delete(count='exact', returning='minimal')
+                .eq('id', note_id)
+                .execute()
+        )
         
-        success = len(response.data) > 0
+        success = (response.count or 0) > 0
         if success:
+            invalidate_search_cache()
             logger.info(f"Successfully deleted note with ID: {note_id}")
         else:
             logger.warning(f"No note found with ID: {note_id}")
@@ -281,6 +992,7 @@ async def delete_note(note_id: Union[str, int]) -> bool:
 
 if __name__ == "__main__":
     import uvicorn
+    from contextlib import asynccontextmanager
     from mcp.server.sse import SseServerTransport
     from starlette.applications import Starlette
     from starlette.routing import Mount, Route
@@ -300,6 +1012,14 @@ if __name__ == "__main__":
                 mcp._mcp_server.create_initialization_options()
             )
     
+    @asynccontextmanager
+    async def lifespan(app):
+        # Create the shared clients once, before the first request
+        await get_supabase()
+        get_openai()
+        get_tokenizer()
+        yield
+    
     # Create Starlette app with routes
     starlette_app = Starlette(
         debug=True,
@@ -307,6 +1027,7 @@ if __name__ == "__main__":
             Route("/sse", endpoint=handle_sse),
             Mount("/messages/", app=sse.handle_post_message),
         ],
+        lifespan=lifespan,
     )
     
     # Run the server
@@ -4,15 +4,19 @@ CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 -- Drop existing objects if they exist
 DROP FUNCTION IF EXISTS match_documents(vector, integer, jsonb);
+DROP FUNCTION IF EXISTS match_documents(halfvec, integer, jsonb);
+DROP FUNCTION IF EXISTS get_document(integer);
 DROP FUNCTION IF EXISTS validate_note_metadata();
 DROP TRIGGER IF EXISTS validate_note_metadata_trigger ON notes;
 DROP TABLE IF EXISTS notes CASCADE;
 
--- Create the notes table with proper column types
+-- Create the notes table with proper column types. Embeddings are stored as
+-- half-precision vectors (requires pgvector 0.7+), halving the size of the
+-- table and the HNSW index compared to vector(1536).
 CREATE TABLE notes (
     id SERIAL PRIMARY KEY,
     content TEXT NOT NULL,
-    embedding vector(1536) NOT NULL,
+    embedding halfvec(1536) NOT NULL,
     metadata JSONB NOT NULL DEFAULT '{
         "loc": null,
         "source": "file_system",
@@ -44,13 +48,15 @@ CREATE INDEX idx_notes_blob_type ON notes USING gin ((metadata->>'blobType') gin
 CREATE INDEX idx_notes_directory ON notes USING gin ((metadata->>'directory') gin_trgm_ops);
 CREATE INDEX idx_notes_created_at ON notes USING gin ((metadata->>'created_at') gin_trgm_ops);
 CREATE INDEX idx_notes_processing_info ON notes USING gin ((metadata->'processing_info'));
+-- Exact-match lookups on file_hash let add_notes skip notes that are already stored
+CREATE INDEX idx_notes_file_hash ON notes ((metadata->>'file_hash'));
 
 -- Create an index for faster similarity searches
-CREATE INDEX ON notes USING hnsw (embedding vector_cosine_ops);
+CREATE INDEX idx_notes_embedding ON notes USING hnsw (embedding halfvec_cosine_ops);
 
 -- Create the match_documents function with proper column references
 CREATE OR REPLACE FUNCTION match_documents(
-    query_embedding vector(1536),
+    query_embedding halfvec(1536),
     match_count int DEFAULT 5,
     filter jsonb DEFAULT '{}'::jsonb
 )
@@ -68,18 +74,41 @@ BEGIN
         n.id,
         n.content,
         n.metadata,
-        1 - (n.embedding <=> query_embedding) as similarity
+        -- Cosine similarity rescaled from [-1, 1] to [0, 1]
+        0.5 + (1 - (n.embedding <=> query_embedding)) * 0.5 as similarity
     FROM notes n
     WHERE
         CASE
             WHEN filter::text = '{}'::text THEN true
             ELSE n.metadata @> filter
         END
+    -- Ordering by distance is equivalent to similarity DESC and lets the HNSW index serve the query
     ORDER BY n.embedding <=> query_embedding
     LIMIT match_count;
 END;
 $$;
 
+-- Create the get_document function, returning the embedding as a plain float array
+-- so clients receive JSON numbers instead of pgvector's text representation
+CREATE OR REPLACE FUNCTION get_document(note_id int)
+RETURNS TABLE (
+    id int,
+    content text,
+    metadata jsonb,
+    embedding real[]
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT
+        n.id,
+        n.content,
+        n.metadata,
+        n.embedding::vector::real[] as embedding
+    FROM notes n
+    WHERE n.id = note_id;
+$$;
+
 -- Create function to validate metadata structure
 CREATE OR REPLACE FUNCTION validate_note_metadata()
 RETURNS TRIGGER AS $$
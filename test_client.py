@@ -61,7 +61,7 @@ async def main():
         print("\nSearch results:")
         for result in results:
             print(f"\nID: {result['id']}")
-            print(f"Content: {result['content']}")
+            print(f"Snippet: {result['snippet']}")
             print(f"Metadata: {result['metadata']}")
             print(f"Similarity: {result['similarity']}")
     except Exception as e: